@@ -1,16 +1,30 @@
-import os, sys, time, traceback
-from typing import List, Dict
+import asyncio, os, re, signal, sys, time, traceback
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import List, Dict, Optional, Tuple
 from datetime import datetime, timedelta, timezone
 from urllib.parse import urlparse, quote_plus
 
-import feedparser
+import aiohttp
 import yaml
-from influxdb_client import InfluxDBClient, Point, WriteOptions
+try:
+    from yaml import CSafeLoader as YamlLoader  # libyaml-backed
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+from lxml import etree
+from influxdb_client import InfluxDBClient, WriteApi, WriteOptions
+from influxdb_client.client.write_api import WriteType
 from email.utils import parsedate_to_datetime
 
 VERSION = "news-reload-v2"
 ENV_PATH = "/app/.env"
 
+# news is written synchronously: write() raises on a failed request, so items are only marked
+# seen once InfluxDB has accepted them (batching mode would report errors in a background thread)
+WRITE_OPTIONS = WriteOptions(write_type=WriteType.synchronous)
+WRITE_BATCH = 5_000  # InfluxDB's recommended points per request
+
 # ------------- tiny .env reader (no extra deps) -------------
 def read_env_file(path: str) -> Dict[str, str]:
     out: Dict[str, str] = {}
@@ -29,8 +43,21 @@ def read_env_file(path: str) -> Dict[str, str]:
         pass
     return out
 
+# (mtime_ns, parsed) of ENV_PATH; re-read only when the file changes
+_env_cache: Tuple[Optional[int], Dict[str, str]] = (None, {})
+
+def read_env_cached() -> Dict[str, str]:
+    global _env_cache
+    try:
+        mtime = os.stat(ENV_PATH).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    if mtime != _env_cache[0]:
+        _env_cache = (mtime, read_env_file(ENV_PATH))
+    return _env_cache[1]
+
 def merged_env() -> Dict[str, str]:
-    env = read_env_file(ENV_PATH)
+    env = dict(read_env_cached())
     env.update(os.environ)  # container env wins
     return env
 
@@ -49,37 +76,110 @@ def cfg_from_env(e: Dict[str, str]) -> Dict[str, object]:
 # ---- Settings / guards ----
 FUTURE_CLAMP = timedelta(minutes=5)  # clamp accidental future timestamps
 FEEDS_PATH = "/app/feeds.yaml"
+FETCH_CONCURRENCY = 16      # open connections at once; keeps us under feed rate limits
+FETCH_TIMEOUT = 10
+STALE_BREAK = 3             # consecutive entries older than the cutoff before we stop reading a feed
+RELEVANCE_SORTED_FEEDS = ("https://news.google.com/rss/search",)  # not date-ordered, read in full
+
+ATOM = "{http://www.w3.org/2005/Atom}"
+RSS1 = "{http://purl.org/rss/1.0/}"
+DC_DATE = "{http://purl.org/dc/elements/1.1/}date"
+# tolerate slightly broken feeds, like feedparser did; no sanitizing/entity expansion/URI
+# resolution (we store raw title+summary), and drop nodes we never read
+_xml_parser = etree.XMLParser(recover=True, resolve_entities=False, no_network=True,
+                              remove_comments=True, remove_pis=True)
+
+# feed url -> (etag, last_modified) for conditional GETs across poll cycles
+_feed_meta: Dict[str, Tuple[str, str]] = {}
+# (ticker, url) keys already written to influx, oldest first
+SEEN_MAX = 50_000
+_seen: "OrderedDict[Tuple[str, str], None]" = OrderedDict()
+
+def mark_seen(keys):
+    for k in keys:
+        _seen[k] = None
+        _seen.move_to_end(k)
+    while len(_seen) > SEEN_MAX:
+        _seen.popitem(last=False)
+
+def reset_feed_cache():
+    # forget validators so the next cycle re-reads every feed in full
+    _feed_meta.clear()
+
+# line-protocol escaping (same sets influxdb-client uses)
+_TAG_ESCAPE = str.maketrans({",": r"\,", "=": r"\=", " ": r"\ ", "\n": r"\n", "\t": r"\t", "\r": r"\r"})
+_STR_ESCAPE = str.maketrans({'"': r'\"', "\\": r"\\"})
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def news_line(ticker: str, source: str, title: str, summary: str, url: str, ts: datetime) -> str:
+    tags = f",source={source.translate(_TAG_ESCAPE)}" if source else ""  # influx rejects empty tag values
+    ts_ns = (ts - EPOCH) // timedelta(microseconds=1) * 1_000
+    return (f'lse_news{tags},ticker={ticker.translate(_TAG_ESCAPE)} '
+            f'summary="{summary.translate(_STR_ESCAPE)}",title="{title.translate(_STR_ESCAPE)}",url="{url.translate(_STR_ESCAPE)}" {ts_ns}')
 
+@lru_cache(maxsize=4096)
 def domain_from_url(u: str) -> str:
     try:
         return urlparse(u).netloc or ""
     except Exception:
         return ""
 
-def load_feeds_config(tickers: List[str]) -> Dict[str, List[str]]:
+# (mtime_ns, parsed) of FEEDS_PATH; re-parsed only when the file changes
+_feeds_cache: Tuple[Optional[int], Dict[str, List[str]]] = (None, {})
+
+def read_feeds_file() -> Dict[str, List[str]]:
+    global _feeds_cache
+    try:
+        mtime = os.stat(FEEDS_PATH).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    if mtime == _feeds_cache[0]:
+        return _feeds_cache[1]
     cfg: Dict[str, List[str]] = {}
-    if os.path.exists(FEEDS_PATH):
-        try:
-            with open(FEEDS_PATH, "r", encoding="utf-8") as f:
-                loaded = yaml.safe_load(f) or {}
-                if isinstance(loaded, dict):
-                    for k, v in loaded.items():
-                        if isinstance(v, list):
-                            cfg[str(k)] = [str(x) for x in v]
-        except Exception as e:
-            print(f"[news] failed to read feeds.yaml: {e}", file=sys.stderr)
+    try:
+        with open(FEEDS_PATH, "r", encoding="utf-8") as f:
+            loaded = yaml.load(f, Loader=YamlLoader) or {}
+            if isinstance(loaded, dict):
+                for k, v in loaded.items():
+                    if isinstance(v, list):
+                        cfg[str(k)] = [str(x) for x in v]
+    except Exception as e:
+        print(f"[news] failed to read feeds.yaml: {e}", file=sys.stderr)
+        return cfg
+    _feeds_cache = (mtime, cfg)
+    return cfg
 
+def load_feeds_config(tickers: List[str]) -> Dict[str, List[str]]:
+    cfg = dict(read_feeds_file())
     for t in tickers:
         if t not in cfg or not cfg[t]:
             cfg[t] = [f"https://news.google.com/rss/search?q={quote_plus(t)}&hl=en-GB&gl=GB&ceid=GB:en"]
     return cfg
 
+# fast paths for the two date shapes feeds actually use; anything else goes to the stdlib parsers
+_RFC822 = re.compile(r"^\w{3}, (\d{1,2}) (\w{3}) (\d{4}) (\d{2}):(\d{2}):(\d{2}) ([+\-]\d{4}|GMT|UTC)$")
+_ISO8601 = re.compile(r"^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}")
+_MONTHS = {m: i for i, m in enumerate(("Jan", "Feb", "Mar", "Apr", "May", "Jun",
+                                       "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"), 1)}
+
+def _parse_date(s: str) -> datetime:
+    s = s.strip()
+    m = _RFC822.match(s)
+    if m and m.group(2) in _MONTHS:  # RSS pubDate, e.g. "Mon, 13 Oct 2026 10:00:00 GMT"
+        day, mon, year, hh, mm, ss, tz = m.groups()
+        offset = 0 if tz in ("GMT", "UTC") else (1 if tz[0] == "+" else -1) * (int(tz[1:3]) * 60 + int(tz[3:5]))
+        return datetime(int(year), _MONTHS[mon], int(day), int(hh), int(mm), int(ss),
+                        tzinfo=timezone(timedelta(minutes=offset)))
+    if _ISO8601.match(s):
+        return datetime.fromisoformat(s)  # Atom / dc:date
+    return parsedate_to_datetime(s)  # other RFC 2822 variants
+
 def parse_time(entry) -> datetime:
-    for key in ("published", "updated", "dc:date", "date"):
+    for key in ("published", "updated"):
         s = entry.get(key)
         if s:
             try:
-                dt = parsedate_to_datetime(s)
+                dt = _parse_date(s)
                 if dt.tzinfo is None:
                     dt = dt.replace(tzinfo=timezone.utc)
                 ts = dt.astimezone(timezone.utc)
@@ -87,46 +187,154 @@ def parse_time(entry) -> datetime:
             except Exception:
                 pass
     else:
-        if getattr(entry, "published_parsed", None):
-            ts = datetime(*entry.published_parsed[:6], tzinfo=timezone.utc)
-        elif getattr(entry, "updated_parsed", None):
-            ts = datetime(*entry.updated_parsed[:6], tzinfo=timezone.utc)
-        else:
-            ts = datetime.now(timezone.utc)
+        ts = datetime.now(timezone.utc)
 
     now_utc = datetime.now(timezone.utc)
     if ts > now_utc + FUTURE_CLAMP:
         ts = now_utc
     return ts
 
-def fetch_news_for_ticker(ticker: str, feeds: List[str], cutoff: datetime, require_ticker: bool, extra_keywords) -> list:
-    items = []
-    t_lc = ticker.lower()
-    for url in feeds:
-        try:
-            d = feedparser.parse(url)
-        except Exception as e:
-            print(f"[news] feed error {url}: {e}", file=sys.stderr)
-            continue
-
-        for e in d.get("entries", []):
+def _text(el, path: str) -> str:
+    child = el.find(path)
+    if child is None:
+        return ""
+    return "".join(child.itertext())
+
+def parse_feed_xml(content: bytes) -> List[Dict[str, object]]:
+    """RSS 2.0 / RSS 1.0 (RDF) <item> and Atom <entry> elements as feedparser-style entry dicts."""
+    root = etree.fromstring(content, _xml_parser)
+    if root is None:
+        return []
+    entries = []
+    for ns in ("", RSS1):  # RSS 2.0 items are un-namespaced, RSS 1.0 items live in the RSS1 namespace
+        for it in root.iterfind(f".//{ns}item"):
+            entries.append({
+                "title": _text(it, f"{ns}title"),
+                "link": _text(it, f"{ns}link").strip(),
+                "summary": _text(it, f"{ns}description"),
+                "published": _text(it, "pubDate") or _text(it, DC_DATE),
+                "source": {"title": _text(it, "source")},
+            })
+    for en in root.iterfind(f".//{ATOM}entry"):
+        link = en.find(f"{ATOM}link[@rel='alternate']")
+        if link is None:
+            link = en.find(f"{ATOM}link")
+        entries.append({
+            "title": _text(en, f"{ATOM}title"),
+            "link": (link.get("href") or "") if link is not None else "",
+            "summary": _text(en, f"{ATOM}summary") or _text(en, f"{ATOM}content"),
+            "published": _text(en, f"{ATOM}published"),
+            "updated": _text(en, f"{ATOM}updated"),
+            "source": {"title": _text(en, f"{ATOM}source/{ATOM}title")},
+        })
+    return entries
+
+async def _fetch_feed(session: aiohttp.ClientSession, limit: asyncio.Semaphore, url: str):
+    headers = {}
+    etag, modified = _feed_meta.get(url, ("", ""))
+    if etag:
+        headers["If-None-Match"] = etag
+    if modified:
+        headers["If-Modified-Since"] = modified
+    try:
+        # wait for a slot before the request starts, so FETCH_TIMEOUT only counts our own request
+        async with limit, session.get(url, headers=headers) as resp:
+            if resp.status == 304:
+                return []  # unchanged since last cycle
+            resp.raise_for_status()
+            body = await resp.read()
+            meta = (resp.headers.get("ETag", ""), resp.headers.get("Last-Modified", ""))
+        entries = parse_feed_xml(body)
+        _feed_meta[url] = meta
+        return entries
+    except Exception as e:
+        print(f"[news] feed error {url}: {e}", file=sys.stderr)
+        return None
+
+async def _fetch_feeds(pairs: List[Tuple[str, str]]) -> list:
+    limit = asyncio.Semaphore(FETCH_CONCURRENCY)
+    async with aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=FETCH_TIMEOUT),
+            connector=aiohttp.TCPConnector(limit=FETCH_CONCURRENCY),
+            headers={"User-Agent": f"stockops-news/{VERSION}"}) as session:
+        return await asyncio.gather(*(_fetch_feed(session, limit, url) for _, url in pairs))
+
+def fetch_feeds(pairs: List[Tuple[str, str]]) -> Dict[str, list]:
+    """Fetch all (ticker, url) feeds concurrently; returns ticker -> [(url, entries)]."""
+    out: Dict[str, list] = {}
+    for (t, url), d in zip(pairs, asyncio.run(_fetch_feeds(pairs))):
+        if d is not None:
+            out.setdefault(t, []).append((url, d))
+    return out
+
+@lru_cache(maxsize=256)
+def keyword_matcher(ticker_lc: str, extra_keywords: Tuple[str, ...]) -> "re.Pattern[str]":
+    # one alternation instead of a substring scan per keyword
+    return re.compile("|".join(re.escape(k) for k in (ticker_lc,) + extra_keywords))
+
+@dataclass
+class NewsBatch:
+    """Matched news items, stored column-wise (one list per field)."""
+    tickers: List[str] = field(default_factory=list)
+    titles: List[str] = field(default_factory=list)
+    summaries: List[str] = field(default_factory=list)
+    urls: List[str] = field(default_factory=list)
+    sources: List[str] = field(default_factory=list)
+    times: List[datetime] = field(default_factory=list)
+
+    def __len__(self) -> int:
+        return len(self.urls)
+
+    def append(self, ticker: str, title: str, summary: str, url: str, source: str, ts: datetime):
+        self.tickers.append(ticker)
+        self.titles.append(title)
+        self.summaries.append(summary)
+        self.urls.append(url)
+        self.sources.append(source)
+        self.times.append(ts)
+
+    def extend(self, other: "NewsBatch"):
+        self.tickers.extend(other.tickers)
+        self.titles.extend(other.titles)
+        self.summaries.extend(other.summaries)
+        self.urls.extend(other.urls)
+        self.sources.extend(other.sources)
+        self.times.extend(other.times)
+
+def fetch_news_for_ticker(ticker: str, docs: list, cutoff: datetime, require_ticker: bool, extra_keywords) -> NewsBatch:
+    items = NewsBatch()
+    seen_urls = set()  # the same story often shows up in several of a ticker's feeds
+    # without require_ticker every entry is wanted, so there is nothing to match
+    matcher = keyword_matcher(ticker.lower(), tuple(extra_keywords)) if require_ticker else None
+    for url, entries in docs:
+        # newest-first feeds: once we've been inside the window, stop after STALE_BREAK old
+        # entries in a row. Never for relevance-sorted feeds, or once a feed shows it isn't
+        # date-ordered, since fresh items can follow stale ones there.
+        ordered = not url.startswith(RELEVANCE_SORTED_FEEDS)
+        prev_ts, in_window, stale = None, False, 0
+        for e in entries:
             title = (e.get("title") or "").strip()
-            summary = (e.get("summary") or e.get("description") or "").strip()
+            # only the stored 800 chars are kept/searched; don't copy multi-KB HTML bodies around
+            summary = (e.get("summary") or e.get("description") or "")[:1024].strip()[:800]
             link = e.get("link") or ""
             if not title or not link:
                 continue
+            if link in seen_urls or (ticker, link) in _seen:
+                continue
+            seen_urls.add(link)
 
             ts = parse_time(e)
+            if prev_ts is not None and ts > prev_ts:
+                ordered = False
+            prev_ts = ts
             if ts < cutoff:
+                stale += 1
+                if ordered and in_window and stale >= STALE_BREAK:
+                    break
                 continue
+            in_window, stale = True, 0
 
-            text_lc = (title + " " + summary).lower()
-            want = True
-            if require_ticker:
-                want = t_lc in text_lc
-            if extra_keywords:
-                want = want or any(kw in text_lc for kw in extra_keywords)
-            if not want:
+            if matcher is not None and not (matcher.search(title.lower()) or matcher.search(summary.lower())):
                 continue
 
             source = ""
@@ -139,51 +347,40 @@ def fetch_news_for_ticker(ticker: str, feeds: List[str], cutoff: datetime, requi
             if not source:
                 source = domain_from_url(link)
 
-            items.append({
-                "ticker": ticker,
-                "title": title,
-                "summary": summary[:800],
-                "url": link,
-                "source": source,
-                "time": ts
-            })
+            items.append(ticker, title, summary, link, source, ts)
     print(f"[news] matched {len(items)} items for {ticker} since {cutoff.isoformat()}")
     return items
 
-def write_news(items, client: InfluxDBClient, bucket: str, org: str):
+def write_news(items: NewsBatch, write_api: WriteApi, bucket: str, org: str):
     if not items:
         print("[influx] news: nothing new")
         return
-    write_api = client.write_api(write_options=WriteOptions(batch_size=500, flush_interval=5_000, jitter_interval=1_000))
-    seen = set()
-    points = []
-    for it in items:
-        key = (it["ticker"], it["url"])
-        if key in seen:
-            continue
-        seen.add(key)
-        p = (Point("lse_news")
-             .tag("ticker", it["ticker"])
-             .tag("source", it["source"] or "")
-             .field("title", it["title"])
-             .field("summary", it["summary"])
-             .field("url", it["url"])
-             .time(it["time"]))
-        points.append(p)
+    lines = [news_line(*row) for row in zip(items.tickers, items.sources, items.titles, items.summaries, items.urls, items.times)]
+    keys = list(zip(items.tickers, items.urls))
+    written = 0
     try:
-        write_api.write(bucket=bucket, org=org, record=points)
-        print(f"[influx] wrote {len(points)} news points")
+        for i in range(0, len(lines), WRITE_BATCH):
+            write_api.write(bucket=bucket, org=org, record=lines[i:i + WRITE_BATCH])
+            mark_seen(keys[i:i + WRITE_BATCH])
+            written += len(lines[i:i + WRITE_BATCH])
+        print(f"[influx] wrote {written} news points")
     except Exception as e:
-        print(f"[influx] write news error: {e}", file=sys.stderr)
+        print(f"[influx] write news error after {written} of {len(lines)} points: {e}", file=sys.stderr)
+        reset_feed_cache()  # make sure the next cycle sees the unwritten items again
 
-def backfill_once(client: InfluxDBClient, tickers: List[str], feeds_cfg: Dict[str, List[str]], backfill_days: int, require_ticker: bool, extra_keywords):
+def collect_news(tickers: List[str], feeds_cfg: Dict[str, List[str]], cutoff: datetime, require_ticker: bool, extra_keywords) -> NewsBatch:
+    pairs = [(t, url) for t in tickers for url in feeds_cfg.get(t, [])]
+    docs = fetch_feeds(pairs)
+    all_items = NewsBatch()
+    for t in tickers:
+        all_items.extend(fetch_news_for_ticker(t, docs.get(t, []), cutoff, require_ticker, extra_keywords))
+    return all_items
+
+def backfill_once(write_api: WriteApi, tickers: List[str], feeds_cfg: Dict[str, List[str]], backfill_days: int, require_ticker: bool, extra_keywords):
     cutoff = datetime.now(timezone.utc) - timedelta(days=backfill_days)
     print(f"[backfill] start days={backfill_days} (cutoff={cutoff.isoformat()})")
-    all_items = []
-    for t in tickers:
-        feeds = feeds_cfg.get(t, [])
-        all_items.extend(fetch_news_for_ticker(t, feeds, cutoff, require_ticker, extra_keywords))
-    write_news(all_items, client, os.getenv("INFLUX_BUCKET", "lse"), os.getenv("INFLUX_ORG", "stocks"))
+    all_items = collect_news(tickers, feeds_cfg, cutoff, require_ticker, extra_keywords)
+    write_news(all_items, write_api, os.getenv("INFLUX_BUCKET", "lse"), os.getenv("INFLUX_ORG", "stocks"))
     print("[backfill] done")
 
 def main():
@@ -197,9 +394,13 @@ def main():
     print(f"{VERSION} | InfluxDB: {INFLUX_URL}, org={INFLUX_ORG}, bucket={INFLUX_BUCKET}, tickers={cfg0['tickers']} (.env hot-reload at {ENV_PATH})")
 
     feeds_cfg = load_feeds_config(cfg0["tickers"])
-    with InfluxDBClient(url=INFLUX_URL, token=INFLUX_TOKEN, org=INFLUX_ORG) as client:
+    # k8s stops pods with SIGTERM; turn it into SystemExit so the with-blocks below flush
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    # one write_api for the process lifetime
+    with InfluxDBClient(url=INFLUX_URL, token=INFLUX_TOKEN, org=INFLUX_ORG) as client, \
+            client.write_api(write_options=WRITE_OPTIONS) as write_api:
         if cfg0["backfill_on_start"]:
-            backfill_once(client, cfg0["tickers"], feeds_cfg, cfg0["backfill_days"], cfg0["require_ticker"], cfg0["extra_keywords"])
+            backfill_once(write_api, cfg0["tickers"], feeds_cfg, cfg0["backfill_days"], cfg0["require_ticker"], cfg0["extra_keywords"])
 
         last_cfg = cfg0
         while True:
@@ -208,16 +409,14 @@ def main():
                 cfg = cfg_from_env(e)
                 if cfg != last_cfg:
                     print(f"[config] reloaded: {cfg}")
+                    reset_feed_cache()  # filters may have changed
                     if cfg["tickers"] != last_cfg["tickers"]:
                         feeds_cfg = load_feeds_config(cfg["tickers"])
                     last_cfg = cfg
 
                 cutoff = datetime.now(timezone.utc) - timedelta(hours=cfg["lookback_hours"])
-                all_items = []
-                for t in cfg["tickers"]:
-                    feeds = feeds_cfg.get(t, [])
-                    all_items.extend(fetch_news_for_ticker(t, feeds, cutoff, cfg["require_ticker"], cfg["extra_keywords"]))
-                write_news(all_items, client, INFLUX_BUCKET, INFLUX_ORG)
+                all_items = collect_news(cfg["tickers"], feeds_cfg, cutoff, cfg["require_ticker"], cfg["extra_keywords"])
+                write_news(all_items, write_api, INFLUX_BUCKET, INFLUX_ORG)
             except Exception as e:
                 print(f"[loop] news error: {e}", file=sys.stderr)
                 traceback.print_exc()
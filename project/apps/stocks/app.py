@@ -1,12 +1,17 @@
-import os, sys, time, traceback
-from typing import List, Dict
+import os, signal, sys, time, traceback
+from typing import List, Dict, Optional, Tuple
+import numpy as np
 import pandas as pd
 import yfinance as yf
-from influxdb_client import InfluxDBClient, Point, WriteOptions
+from influxdb_client import InfluxDBClient, WriteApi, WriteOptions
 
 VERSION = "fetcher-reload-v6"
 ENV_PATH = "/app/.env"
 
+# ~5000 points per request is InfluxDB's recommended batch size
+WRITE_OPTIONS = WriteOptions(batch_size=5_000, flush_interval=10_000, jitter_interval=2_000,
+                             retry_interval=5_000, max_retries=3, max_retry_delay=30_000, exponential_base=2)
+
 # Allowed values to keep yfinance happy
 ALLOWED_PERIODS = {
     "1d","5d","1mo","3mo","6mo","1y","2y","5y","10y","ytd","max"
@@ -35,6 +40,19 @@ def read_env_file(path: str) -> Dict[str, str]:
         pass
     return out
 
+# (mtime_ns, parsed) of ENV_PATH; re-read only when the file changes
+_env_cache: Tuple[Optional[int], Dict[str, str]] = (None, {})
+
+def read_env_cached() -> Dict[str, str]:
+    global _env_cache
+    try:
+        mtime = os.stat(ENV_PATH).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    if mtime != _env_cache[0]:
+        _env_cache = (mtime, read_env_file(ENV_PATH))
+    return _env_cache[1]
+
 def merged_env() -> Dict[str, str]:
     # container env (from compose env_file) + mounted file; sanitize both
     env: Dict[str, str] = {}
@@ -42,7 +60,7 @@ def merged_env() -> Dict[str, str]:
     for k, v in os.environ.items():
         env[k] = _clean_value(v) if isinstance(v, str) else v
     # Overlay with file (lets you hot-edit /app/.env without recreating container)
-    for k, v in read_env_file(ENV_PATH).items():
+    for k, v in read_env_cached().items():
         env[k] = _clean_value(v)
     return env
 
@@ -97,19 +115,35 @@ def get_cfg() -> Dict[str, object]:
     }
 
 # -------------------- helpers --------------------
-def ensure_utc(ts):
-    return pd.to_datetime(ts, utc=True).to_pydatetime()
-
-def normalize_datetime(df: pd.DataFrame) -> pd.DataFrame:
-    df = df.reset_index()
-    if 'Date' in df.columns:
-        df = df.rename(columns={'Date': 'datetime'})
-    elif 'Datetime' in df.columns:
-        df = df.rename(columns={'Datetime': 'datetime'})
-    elif 'index' in df.columns:
-        df = df.rename(columns={'index': 'datetime'})
-    df['datetime'] = pd.to_datetime(df['datetime'], utc=True)
-    return df
+# line-protocol escaping for tag values (same set influxdb-client uses)
+_TAG_ESCAPE = str.maketrans({",": r"\,", "=": r"\=", " ": r"\ ", "\n": r"\n", "\t": r"\t", "\r": r"\r"})
+FLOAT_FIELDS = ("open", "high", "low", "close", "adj_close")
+COLUMNS = ['ticker','datetime','open','high','low','close','adj_close','volume','currency']
+YF_RENAME = {
+    'Open': 'open', 'High': 'high', 'Low': 'low',
+    'Close': 'close', 'Adj Close': 'adj_close', 'Volume': 'volume',
+}
+
+# ticker -> currency; fast_info is a network call, so look each ticker up once
+_currency_cache: Dict[str, str] = {}
+
+def currency_for(t: str) -> str:
+    if t not in _currency_cache:
+        currency = ''
+        try:
+            info = yf.Ticker(t).fast_info
+            currency = getattr(info, 'currency', None) or (info.get('currency') if isinstance(info, dict) else None) or ''
+        except Exception:
+            pass
+        if not currency:
+            return ''  # don't cache failures, retry next cycle
+        _currency_cache[t] = currency
+    return _currency_cache[t]
+
+def prune_currency_cache(tickers: List[str]):
+    for t in list(_currency_cache):
+        if t not in tickers:
+            del _currency_cache[t]
 
 def fetch(tickers: List[str], period: str, interval: str) -> pd.DataFrame:
     data = yf.download(
@@ -121,74 +155,88 @@ def fetch(tickers: List[str], period: str, interval: str) -> pd.DataFrame:
         progress=False,
         threads=True,
     )
-    frames = []
+    if data is None or data.empty:
+        print(f"[fetch] No data for {tickers}", file=sys.stderr)
+        return pd.DataFrame(columns=COLUMNS)
+
+    # one reshape to long format (datetime, ticker) instead of slicing/copying a frame per ticker
+    if isinstance(data.columns, pd.MultiIndex):
+        long = data.stack(level=0, future_stack=True)
+    else:
+        long = data.assign(ticker=tickers[0]).set_index('ticker', append=True)
+    long.index.names = ['datetime', 'ticker']
+    df = long.reset_index().rename(columns=YF_RENAME).reindex(columns=COLUMNS).rename_axis(columns=None)
+    # the download is outer-joined on time, so drop the bars a ticker doesn't have
+    df = df.dropna(subset=list(YF_RENAME.values()), how='all')
+    present = set(df['ticker'])
     for t in tickers:
-        if isinstance(data.columns, pd.MultiIndex):
-            if t in data.columns.get_level_values(0):
-                df_t = data[t].copy()
-            else:
-                print(f"[fetch] No data for {t}", file=sys.stderr)
-                continue
-        else:
-            df_t = data.copy()
-
-        if df_t is None or df_t.empty:
-            print(f"[fetch] Empty df for {t}", file=sys.stderr)
-            continue
-
-        df_t = normalize_datetime(df_t).rename(columns={
-            'Open': 'open', 'High': 'high', 'Low': 'low',
-            'Close': 'close', 'Adj Close': 'adj_close', 'Volume': 'volume',
-        })
-        df_t['ticker'] = t
+        if t not in present:
+            print(f"[fetch] No data for {t}", file=sys.stderr)
+    if df.empty:
+        return pd.DataFrame(columns=COLUMNS)
 
-        currency = ''
-        try:
-            info = yf.Ticker(t).fast_info
-            currency = getattr(info, 'currency', None) or (info.get('currency') if isinstance(info, dict) else None) or ''
-        except Exception:
-            pass
-        df_t['currency'] = currency
-        df_t = df_t[['ticker','datetime','open','high','low','close','adj_close','volume','currency']]
-        frames.append(df_t)
+    df['datetime'] = pd.to_datetime(df['datetime'], utc=True)
+    df['currency'] = df['ticker'].map({t: currency_for(t) for t in df['ticker'].unique()})
+    return df.sort_values(['ticker','datetime'], ignore_index=True)
+
+def rows_since(df: pd.DataFrame, cutoff: pd.Timestamp) -> pd.DataFrame:
+    # df is sorted by (ticker, datetime): binary-search the cutoff inside each ticker block
+    tickers = df["ticker"].to_numpy()
+    starts = np.flatnonzero(np.r_[True, tickers[1:] != tickers[:-1]])
+    ends = np.r_[starts[1:], len(df)]
+    ts = df["datetime"].dt.tz_convert(None).to_numpy()
+    c = np.datetime64(cutoff.tz_convert(None))
+    keep = [np.arange(s + ts[s:e].searchsorted(c), e) for s, e in zip(starts, ends)]
+    return df.iloc[np.concatenate(keep)]
+
+def _tag(key: str, col: pd.Series) -> pd.Series:
+    # ",key=value" per row; empty tag values are dropped, like Point does
+    vals = col.fillna("").astype(str).str.translate(_TAG_ESCAPE)
+    return ("," + key + "=" + vals).where(vals != "", "")
+
+def to_line_protocol(df: pd.DataFrame) -> List[str]:
+    # numeric block as one float matrix; NaN/inf fields are skipped, rows with no fields dropped up front
+    num = df[list(FLOAT_FIELDS) + ["volume"]].to_numpy(dtype="float64")
+    ok = np.isfinite(num)
+    keep = ok.any(axis=1)
+    if not keep.any():
+        return []
+    df, num, ok = df[keep], num[keep], ok[keep]
+
+    ts_ns = df["datetime"].dt.tz_convert("UTC").dt.tz_localize(None).astype("datetime64[ns]").astype("int64")
+    exchange = pd.Series(np.where(df["ticker"].str.endswith(".L"), "LSE", "US"), index=df.index)
+
+    # ",name=value" per present field
+    fields = pd.Series("", index=df.index)
+    for j, col in enumerate(FLOAT_FIELDS):
+        v = pd.Series(num[:, j], index=df.index)
+        fields = fields + ("," + col + "=" + v.astype(str)).where(ok[:, j], "")
+    vol = pd.Series(np.where(ok[:, -1], num[:, -1], 0).astype("int64"), index=df.index)
+    fields = fields + (",volume=" + vol.astype(str) + "i").where(ok[:, -1], "")
 
-    if not frames:
-        return pd.DataFrame(columns=['ticker','datetime','open','high','low','close','adj_close','volume','currency'])
-    return pd.concat(frames, ignore_index=True).sort_values(['ticker','datetime'])
+    lines = ("lse_prices" + _tag("currency", df["currency"]) + _tag("exchange", exchange) + _tag("ticker", df["ticker"])
+             + " " + fields.str[1:] + " " + ts_ns.astype(str))
+    return lines.tolist()
 
-def write_to_influx(df: pd.DataFrame, client: InfluxDBClient, bucket: str, org: str):
+def write_to_influx(df: pd.DataFrame, write_api: WriteApi, bucket: str, org: str):
     if df.empty:
         print("[influx] nothing to write")
         return
-    write_api = client.write_api(write_options=WriteOptions(batch_size=500, flush_interval=5_000, jitter_interval=1_000))
-    points = []
-    for _, row in df.iterrows():
-        ts = ensure_utc(row["datetime"])
-        ticker = row["ticker"]
-        exchange = "LSE" if ticker.endswith(".L") else "US"
-        p = Point("lse_prices").tag("ticker", ticker).tag("exchange", exchange).tag("currency", row.get("currency") or "")
-        if pd.notna(row["open"]):      p = p.field("open", float(row["open"]))
-        if pd.notna(row["high"]):      p = p.field("high", float(row["high"]))
-        if pd.notna(row["low"]):       p = p.field("low",  float(row["low"]))
-        if pd.notna(row["close"]):     p = p.field("close", float(row["close"]))
-        if pd.notna(row["adj_close"]): p = p.field("adj_close", float(row["adj_close"]))
-        if pd.notna(row["volume"]):    p = p.field("volume", int(row["volume"]))
-        p = p.time(ts)
-        points.append(p)
+    lines = to_line_protocol(df)
     try:
-        write_api.write(bucket=bucket, org=org, record=points)
-        print(f"[influx] wrote {len(points)} points")
+        write_api.write(bucket=bucket, org=org, record=lines)
+        print(f"[influx] wrote {len(lines)} points")
     except Exception as e:
         print(f"[influx] write error: {e}", file=sys.stderr)
 
-def backfill_once(client: InfluxDBClient, tickers: List[str], yf_interval: str, backfill_period: str, org: str, bucket: str):
+def backfill_once(write_api: WriteApi, tickers: List[str], yf_interval: str, backfill_period: str, org: str, bucket: str):
     try:
         period = backfill_period or default_backfill_period(yf_interval)
         if period not in ALLOWED_PERIODS:
             period = "5d"
         print(f"[backfill] start period={period} interval={yf_interval} tickers={tickers}")
         df = fetch(tickers, period, yf_interval)
-        write_to_influx(df, client, bucket, org)
+        write_to_influx(df, write_api, bucket, org)
         print("[backfill] done")
     except Exception as e:
         print(f"[backfill] error: {e}", file=sys.stderr)
@@ -203,9 +251,13 @@ def main():
     cfg0 = get_cfg()
     print(f"{VERSION} | InfluxDB: {INFLUX_URL}, org={INFLUX_ORG}, bucket={INFLUX_BUCKET}, tickers={cfg0['tickers']} (hot-reload .env at {ENV_PATH})")
 
-    with InfluxDBClient(url=INFLUX_URL, token=INFLUX_TOKEN, org=INFLUX_ORG) as client:
+    # k8s stops pods with SIGTERM; turn it into SystemExit so the with-blocks below flush
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    # one write_api for the process lifetime so batching spans poll cycles; closing it flushes
+    with InfluxDBClient(url=INFLUX_URL, token=INFLUX_TOKEN, org=INFLUX_ORG) as client, \
+            client.write_api(write_options=WRITE_OPTIONS) as write_api:
         if cfg0["backfill_on_start"]:
-            backfill_once(client, cfg0["tickers"], cfg0["yf_interval"], cfg0["backfill_period"], INFLUX_ORG, INFLUX_BUCKET)
+            backfill_once(write_api, cfg0["tickers"], cfg0["yf_interval"], cfg0["backfill_period"], INFLUX_ORG, INFLUX_BUCKET)
 
         last_cfg = cfg0
         while True:
@@ -213,14 +265,16 @@ def main():
                 cfg = get_cfg()
                 if cfg != last_cfg:
                     print(f"[config] reloaded: {cfg}")
+                    if cfg["tickers"] != last_cfg["tickers"]:
+                        prune_currency_cache(cfg["tickers"])
                     last_cfg = cfg
 
                 df = fetch(cfg["tickers"], cfg["yf_period"], cfg["yf_interval"])
                 if not df.empty:
                     cutoff = pd.Timestamp.now(tz='UTC') - pd.Timedelta(minutes=30)
-                    df = df[df["datetime"] >= cutoff]
+                    df = rows_since(df, cutoff)
 
-                write_to_influx(df, client, INFLUX_BUCKET, INFLUX_ORG)
+                write_to_influx(df, write_api, INFLUX_BUCKET, INFLUX_ORG)
             except Exception as e:
                 print(f"[loop] error: {e}", file=sys.stderr)
                 traceback.print_exc()